@@ -2,79 +2,194 @@
 """Generate app icon for Worktree Manager using Nano Banana Pro"""
 
 import os
-import base64
+import concurrent.futures
+import functools
+import io
 import subprocess
 import shutil
 from pathlib import Path
+import numpy as np
 from google import genai
 from google.genai import types
-from PIL import Image, ImageDraw, ImageOps
+# pillow-simd works as a drop-in here for faster LANCZOS resampling (see AGENTS.md)
+from PIL import Image, ImageChops
 
-client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY_PAID"))
+try:
+    import cv2
+except ImportError:  # OpenCV is optional; Pillow covers everything
+    cv2 = None
 
-def create_squircle_mask(size, radius_ratio=0.223):
-    """Creates a standard macOS squircle mask."""
-    # macOS icon shape is a superellipse, but a rounded rect with 
-    # specific radius is a very close approximation for this purpose.
-    # Radius is approx 22.3% of the side length.
+def downscale(img, px):
+    """Downscales `img` to px x px.
+
+    Prefers OpenCV's INTER_AREA when cv2 is installed: box-averaging is
+    the right filter for shrinking and its kernels are SIMD-accelerated.
+    Falls back to Pillow LANCZOS, where reducing_gap cheaply box-reduces
+    any step with a ratio above ~2x before the convolution pass.
+    """
+    if cv2 is not None:
+        arr = cv2.resize(np.asarray(img), (px, px), interpolation=cv2.INTER_AREA)
+        # frombuffer keeps the exact mode; fromarray would misread
+        # premultiplied RGBa as plain RGBA.
+        return Image.frombuffer(img.mode, (px, px), arr.tobytes(),
+                                "raw", img.mode, 0, 1)
+    return img.resize((px, px), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+@functools.lru_cache(maxsize=None)
+def create_squircle_mask(size, exponent=5.0):
+    """Creates a standard macOS squircle mask.
+
+    The macOS icon outline is a superellipse (|x|^n + |y|^n = r^n with
+    n ~= 5), which the old ImageDraw rounded rectangle only approximated
+    and drew with a hard edge. Evaluating the curve over a NumPy
+    coordinate grid gives the exact shape with a properly antialiased
+    1-pixel edge, in a handful of vectorized array ops.
+
+    Cached per (size, exponent): several iconset entries share a pixel
+    size (e.g. 16@2x and 32), and the returned mask is only ever read as
+    a paste mask, so sharing one instance is safe.
+    """
     w, h = size
-    radius = int(min(w, h) * radius_ratio)
-    
-    mask = Image.new('L', size, 0)
-    draw = ImageDraw.Draw(mask)
-    draw.rounded_rectangle([(0, 0), size], radius=radius, fill=255)
-    return mask
+    # Pixel-center offsets normalized so the curve clears the edge
+    # midpoints at full opacity (half-pixel outset) and only the corners
+    # fall off.
+    x = np.abs(np.arange(w) + 0.5 - w / 2) / (w / 2 + 0.5)
+    y = np.abs(np.arange(h) + 0.5 - h / 2) / (h / 2 + 0.5)
+    d = (x[np.newaxis, :] ** exponent + y[:, np.newaxis] ** exponent) ** (1.0 / exponent)
+
+    # Antialias across roughly one pixel around the d == 1 contour.
+    edge = 2.0 / min(w, h)
+    alpha = np.clip((1.0 - d) / edge + 0.5, 0.0, 1.0)
+    return Image.fromarray((alpha * 255.0 + 0.5).astype(np.uint8), mode="L")
+
+def encode_icon_size(task):
+    """Encodes one distinct pixel size (thread pool worker).
+
+    Pillow releases the GIL inside its C image ops, so threads overlap
+    the real work here without the pickling a process pool pays to move
+    image buffers. Returns (px, png_bytes); the parent writes the bytes
+    out once per iconset entry sharing that pixel size, so each PNG
+    lands on disk in one write call instead of Pillow's incremental
+    stream writes.
+    """
+    resized_img, px = task
+    # Back to straight alpha exactly once per entry: PNG stores
+    # unpremultiplied pixels.
+    resized_img = resized_img.convert("RGBA")
 
-def generate_icon_sizes(source_path, output_dir):
-    """Generates all required icon sizes from the source image."""
+    # The iconset PNGs are only an intermediate for iconutil, which
+    # re-encodes them into the .icns, so spend as little time in zlib
+    # as possible.
+    buffer = io.BytesIO()
+    resized_img.save(buffer, format="PNG", compress_level=1)
+
+    return px, buffer.getvalue()
+
+def generate_icon_sizes(source, output_dir):
+    """Generates all required icon sizes from the source image.
+
+    `source` is either a path or an already-decoded PIL Image, so callers
+    that just produced the image in memory don't have to round-trip it
+    through the filesystem.
+    """
     output_dir = Path(output_dir)
-    if output_dir.exists():
-        shutil.rmtree(output_dir)
-    output_dir.mkdir(parents=True)
+    # Build into a staging directory and swap it in at the end: any
+    # existing iconset stays intact until the new one is complete, and a
+    # crash mid-run never leaves a half-written output directory behind.
+    staging_dir = output_dir.with_name(output_dir.name + ".staging")
+    if staging_dir.exists():
+        shutil.rmtree(staging_dir)
+    staging_dir.mkdir(parents=True)
 
-    img = Image.open(source_path).convert("RGBA")
-    
-    # Base sizes for macOS icons
+    # The source is decoded exactly once (convert forces the lazy load);
+    # every output below derives from this buffer via the resize cascade,
+    # never by reopening the file.
+    if isinstance(source, Image.Image):
+        img = source.convert("RGBA")
+    else:
+        img = Image.open(source).convert("RGBA")
+
+    # Base sizes for macOS icons, each at normal (@1x) and Retina (@2x)
+    # resolution. Several entries share identical pixel data (16@2x and
+    # 32, 128@2x and 256, 256@2x and 512); iconutil maps each filename to
+    # its own .icns slot, so every entry must exist, but the shared sizes
+    # only need to be rendered and encoded once.
     sizes = [16, 32, 128, 256, 512]
-    
+    names_by_px = {}
     for size in sizes:
-        # Normal resolution (@1x)
-        # We process each size individually to ensure clean edges
-        resized_img = img.resize((size, size), Image.Resampling.LANCZOS)
-        mask = create_squircle_mask((size, size))
-        
-        final_img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
-        final_img.paste(resized_img, (0, 0), mask=mask)
-        
-        final_img.save(output_dir / f"icon_{size}x{size}.png")
-        
-        # Retina resolution (@2x)
-        size_2x = size * 2
-        resized_img_2x = img.resize((size_2x, size_2x), Image.Resampling.LANCZOS)
-        mask_2x = create_squircle_mask((size_2x, size_2x))
-        
-        final_img_2x = Image.new('RGBA', (size_2x, size_2x), (0, 0, 0, 0))
-        final_img_2x.paste(resized_img_2x, (0, 0), mask=mask_2x)
-        
-        final_img_2x.save(output_dir / f"icon_{size}x{size}@2x.png")
+        names_by_px.setdefault(size, []).append(f"icon_{size}x{size}.png")
+        names_by_px.setdefault(size * 2, []).append(f"icon_{size}x{size}@2x.png")
+
+    # Resize largest-first, each step reusing the next-larger result:
+    # LANCZOS cost scales with source x destination, so a chain of ~2x
+    # downscales is far cheaper than resampling the full-resolution
+    # source for every size. (The chain is why the resizes themselves
+    # stay sequential: each step feeds the next, and after dedup the
+    # @1x/@2x tracks share most pixel sizes anyway.)
+    # Fold the squircle mask into the source's alpha channel once at the
+    # largest size; every downscale below then carries the masked alpha
+    # with it, so there is no per-size composite at all.
+    sorted_px = sorted(names_by_px, reverse=True)
+    largest = sorted_px[0]
+    current = downscale(img, largest)
+    mask = create_squircle_mask((largest, largest))
+    current.putalpha(ImageChops.multiply(current.getchannel("A"), mask))
+
+    # Cascade in premultiplied alpha (RGBa): the resample then weights
+    # color by coverage, so masked-out pixels cannot bleed their RGB
+    # into the antialiased edge. Workers convert back to straight RGBA
+    # once per entry when encoding.
+    current = current.convert("RGBa")
+
+    tasks = [(current, largest)]
+    for px in sorted_px[1:]:
+        current = downscale(current, px)
+        tasks.append((current, px))
+
+    # PNG encoding is independent per pixel size, so it fans out across
+    # threads; the parent batches the writes.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        for px, png_bytes in pool.map(encode_icon_size, tasks):
+            for filename in names_by_px[px]:
+                (staging_dir / filename).write_bytes(png_bytes)
+
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    os.replace(staging_dir, output_dir)
 
     print(f"Generated iconset at {output_dir}")
 
 def generate_icns(iconset_path, output_path):
-    """Runs iconutil to generate the .icns file."""
+    """Starts iconutil compiling the .icns file in the background.
+
+    Returns the Popen handle (or None when iconutil is unavailable);
+    hand it to wait_for_icns once the remaining work is done, so the
+    compile overlaps whatever the caller still has to do.
+    """
     try:
-        subprocess.run(
+        return subprocess.Popen(
             ["iconutil", "-c", "icns", str(iconset_path), "-o", str(output_path)],
-            check=True,
-            capture_output=True
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
         )
-        print(f"Successfully compiled .icns to {output_path}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error running iconutil: {e.stderr.decode()}")
     except FileNotFoundError:
         print("Warning: 'iconutil' not found. Are you on macOS? Skipping .icns generation.")
+        return None
+
+def wait_for_icns(process, output_path):
+    """Waits for a background iconutil run and reports the outcome."""
+    if process is None:
+        return
+    _, stderr = process.communicate()
+    if process.returncode == 0:
+        print(f"Successfully compiled .icns to {output_path}")
+    else:
+        print(f"Error running iconutil: {stderr.decode()}")
 
 def generate_icon():
+    # Created lazily so pool workers importing this module don't pay for it.
+    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY_PAID"))
+
     prompt = """Create a raw app icon texture for a 'Git Worktree Manager'.
     
     CRITICAL INSTRUCTION: Generate a FULL BLEED SQUARE image. 
@@ -93,6 +208,10 @@ def generate_icon():
         response_modalities=['TEXT', 'IMAGE'],
         image_config=types.ImageConfig(
             aspect_ratio="1:1",
+            # The largest iconset entry is 1024px (512@2x); a 1K render
+            # starts the cascade at exactly that size instead of paying
+            # for a bigger image that is immediately downscaled.
+            image_size="1K",
         ),
     )
 
@@ -105,22 +224,31 @@ def generate_icon():
 
     for part in response.candidates[0].content.parts:
         if part.inline_data is not None:
-            raw_data = part.inline_data.data
-            image_data = raw_data if isinstance(raw_data, bytes) else base64.b64decode(raw_data)
+            # The SDK hands inline_data.data over as raw bytes (it
+            # base64-decodes on the wire layer), so stream them straight
+            # into Pillow without a decode branch.
+            image_data = part.inline_data.data
+
+            # Process into the iconset first, feeding the decoded image
+            # straight in rather than round-tripping it through a file.
+            # (iconutil itself needs a real .iconset directory, so the
+            # per-size PNGs still hit disk exactly once.)
+            iconset_path = Path(__file__).parent / "AppIcon.iconset"
+            icns_path = Path(__file__).parent / "AppIcon.icns"
+
+            generate_icon_sizes(Image.open(io.BytesIO(image_data)), iconset_path)
+
+            # iconutil compiles the .icns in the background while the
+            # raw render is written out.
+            icns_process = generate_icns(iconset_path, icns_path)
 
-            # Save raw generated image
             raw_output_path = Path(__file__).parent / "icon_generated.png"
             with open(raw_output_path, 'wb') as f:
                 f.write(image_data)
             print(f"Raw icon saved: {raw_output_path}")
-            
-            # Process into iconset and icns
-            iconset_path = Path(__file__).parent / "AppIcon.iconset"
-            icns_path = Path(__file__).parent / "AppIcon.icns"
-            
-            generate_icon_sizes(raw_output_path, iconset_path)
-            generate_icns(iconset_path, icns_path)
-            
+
+            wait_for_icns(icns_process, icns_path)
+
             return
 
     print("No image generated.")